@@ -2,56 +2,182 @@
 import os
 import sys
 import argparse
+import csv
 import hashlib
-import math
+import json
+import mmap
+import multiprocessing as mp
+import re
+import subprocess
+import threading
 from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
 from pydub import AudioSegment
 
+try:
+    import xxhash               # optional: much faster --content-dedup hashing
+except ImportError:
+    xxhash = None
+
 # ─── CONFIG ─────────────────────────────────────────────────────────────────────
 TARGET_RMS_DBFS = -20.0
+MIN_GAIN_DB     = 0.1   # smaller corrections are skipped
 MAX_DURATION_MS = 120 * 60 * 1000           # 120 minutes in ms
 MARGIN_MS       = 2 * 1000                  # subtract 2 seconds = 2000 ms
 CHUNK_SIZE_MS   = MAX_DURATION_MS - MARGIN_MS
 BITRATE         = "192k"
-FFMPEG_PARAMS   = ["-acodec", "libmp3lame", "-b:a", BITRATE, "-write_xing", "0"]
+CODEC_PARAMS    = ["-acodec", "libmp3lame", "-b:a", BITRATE]
+FFMPEG_PARAMS   = CODEC_PARAMS + ["-write_xing", "0"]
 SUPPORTED_EXTS  = (".mp3", ".wav")
 # ────────────────────────────────────────────────────────────────────────────────
 
-def compute_md5(audio: AudioSegment) -> str:
-    """Hash raw PCM bytes for duplicate detection."""
-    return hashlib.md5(audio.raw_data).hexdigest()
-
-def analyze_directory(root_dir):
-    """Walk folder, load all supported files, collect metadata + MD5."""
-    meta = []
-    for dirpath, _, files in os.walk(root_dir):
-        for fn in files:
-            if not fn.lower().endswith(SUPPORTED_EXTS):
-                continue
-            full = os.path.join(dirpath, fn)
-            try:
-                audio = AudioSegment.from_file(full)
-            except Exception as e:
-                print(f"⚠️  Could not open {full}: {e}", file=sys.stderr)
-                continue
-            meta.append({
-                "path":     full,
-                "duration": len(audio),
-                "channels": audio.channels,
-                "dBFS":     audio.dBFS,
-                "md5":      compute_md5(audio),
-            })
-    return meta
+def compute_file_hash(path: str) -> str:
+    """Hash the file's bytes on disk to detect duplicate files.
+
+    The file is memory-mapped, so the hash reads straight from the page cache.
+    """
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:   # empty files can't be mapped
+            return hashlib.blake2b().hexdigest()
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            return hashlib.blake2b(mm).hexdigest()
+
+def compute_pcm_hash(audio: AudioSegment) -> str:
+    """Hash the raw PCM bytes to catch re-encoded duplicates (--content-dedup)."""
+    if xxhash is not None:
+        return xxhash.xxh3_128(audio.raw_data).hexdigest()
+    return hashlib.sha256(audio.raw_data).hexdigest()
+
+def ffprobe_audio(path: str):
+    """Read channel count, duration (ms) and whether the stream is raw PCM
+    via ffprobe, without decoding."""
+    result = subprocess.run(
+        ["ffprobe", "-v", "error", "-select_streams", "a:0",
+         "-show_streams", "-show_format", "-print_format", "json", path],
+        capture_output=True, text=True, check=True,
+    )
+    info = json.loads(result.stdout)
+    stream = info["streams"][0]
+    duration = stream.get("duration") or info["format"]["duration"]
+    return (stream["channels"], int(float(duration) * 1000),
+            stream["codec_name"].startswith("pcm_"))
+
+def measure_dbfs(path: str, channels: int) -> float:
+    """RMS level of a file in dBFS once mixed to `channels`, via volumedetect."""
+    result = subprocess.run(
+        ["ffmpeg", "-hide_banner", "-nostats", "-i", path, "-vn",
+         "-ac", str(channels), "-af", "volumedetect", "-f", "null", "-"],
+        capture_output=True, text=True, check=True,
+    )
+    return float(re.search(r"mean_volume: (\S+) dB", result.stderr).group(1))
+
+def encode_mp3(src, out_base, channels, gain, segment_ms):
+    """Decode, remix, gain and MP3-encode `src` in a single ffmpeg run.
+
+    ffmpeg's segment muxer cuts the stream into ≤ `segment_ms` parts,
+    `<out_base>_part1.mp3`, `_part2`, ..., as it encodes, so the split follows
+    the decoded length, not the container's duration estimate. A file that
+    fits in one part is renamed to `<out_base>.mp3`. Returns a
+    (path, seconds) pair per file written.
+    """
+    cmd = ["ffmpeg", "-hide_banner", "-loglevel", "error", "-y",
+           "-i", src, "-vn", "-ac", str(channels)]
+    if gain:
+        cmd += ["-af", f"volume={gain:.2f}dB"]
+    # mp3 muxer options only reach the segments via -segment_format_options.
+    # The output name is a template, so a literal % in the path is escaped;
+    # ffmpeg lists the parts it wrote, with their times, on stdout, so stale
+    # _partN files from an earlier run aren't picked up
+    listing = subprocess.run(cmd + CODEC_PARAMS + [
+        "-f", "segment", "-segment_time", f"{segment_ms / 1000:.3f}",
+        "-segment_start_number", "1", "-reset_timestamps", "1",
+        "-segment_format_options", "write_xing=0",
+        "-segment_list", "pipe:1", "-segment_list_type", "csv",
+        out_base.replace("%", "%%") + "_part%d.mp3",
+    ], stdout=subprocess.PIPE, check=True).stdout
+    out_dir = os.path.dirname(out_base)
+    parts = [(os.path.join(out_dir, name), float(end) - float(start))
+             for name, start, end in csv.reader(os.fsdecode(listing).splitlines())]
+    if len(parts) == 1:
+        os.replace(parts[0][0], out_base + ".mp3")
+        parts = [(out_base + ".mp3", parts[0][1])]
+    return parts
+
+def encode_chunk(src, out_path, channels, gain, start_ms, end_ms=None):
+    """Encode one [start_ms, end_ms) slice of `src`; end_ms=None runs to EOF."""
+    cmd = ["ffmpeg", "-hide_banner", "-loglevel", "error", "-y",
+           "-ss", f"{start_ms / 1000:.3f}"]
+    if end_ms is not None:
+        cmd += ["-t", f"{(end_ms - start_ms) / 1000:.3f}"]
+    cmd += ["-i", src, "-vn", "-ac", str(channels)]
+    if gain:
+        cmd += ["-af", f"volume={gain:.2f}dB"]
+    subprocess.run(cmd + FFMPEG_PARAMS + [out_path], check=True)
+
+_print_lock = threading.Lock()
+
+def _probe(full, content_dedup=False):
+    """Collect one file's metadata via ffprobe; None if unreadable."""
+    try:
+        dbfs = None
+        if content_dedup:
+            # the decode is paid for already; keep its level for process_file
+            audio = AudioSegment.from_file(full)
+            digest = compute_pcm_hash(audio)
+            dbfs = audio.dBFS if audio.rms else None
+        else:
+            digest = compute_file_hash(full)
+        channels, duration_ms, pcm = ffprobe_audio(full)
+    except Exception as e:
+        with _print_lock:
+            print(f"⚠️  Could not open {full}: {e}", file=sys.stderr)
+        return None
+    return {
+        "path":     full,
+        "duration": duration_ms,
+        "channels": channels,
+        "hash":     digest,
+        "dbfs":     dbfs,
+        "pcm":      pcm,
+    }
+
+def _walk(d, exts):
+    """Yield paths under `d` ending in `exts`, via scandir's cached entry types."""
+    try:
+        it = os.scandir(d)
+    except OSError:             # missing or unreadable: skip it, like os.walk
+        return
+    with it:
+        for e in it:
+            if e.is_dir(follow_symlinks=False):
+                yield from _walk(e.path, exts)
+            elif e.name.lower().endswith(exts):
+                yield e.path
+
+def analyze_directory(root_dir, content_dedup=False):
+    """Walk folder, probe all supported files, collect metadata + hash.
+
+    Probes run on a thread pool so their ffprobe subprocesses overlap.
+    """
+    paths = _walk(root_dir, SUPPORTED_EXTS)   # lazy: probing starts mid-walk
+    probe = partial(_probe, content_dedup=content_dedup)
+    # --content-dedup holds each file's whole decoded PCM (~1.3 GB for a
+    # 2-hour stereo book), so only a few of those run at once
+    cores = os.cpu_count() or 1
+    workers = min(cores, 2) if content_dedup else cores * 2
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        return [m for m in pool.map(probe, paths) if m is not None]
 
 def report_duplicates(meta):
-    """Group by MD5 and report any duplicates."""
+    """Group by hash and report any duplicates."""
     dups = defaultdict(list)
     for m in meta:
-        dups[m["md5"]].append(m["path"])
-    groups = [g for g in dups.values() if len(g) > 1]
+        dups[m["hash"]].append(m["path"])
+    groups = {h: g for h, g in dups.items() if len(g) > 1}
     if groups:
         print("\n?? Duplicate files detected (will skip extras):")
-        for grp in groups:
+        for grp in groups.values():
             print("  - " + "\n    ".join(grp))
     return groups
 
@@ -59,55 +185,69 @@ def decide_target_channels(meta):
     """If any source is stereo, output in stereo; otherwise mono."""
     return 2 if any(m["channels"] > 1 for m in meta) else 1
 
-def split_into_chunks(audio: AudioSegment):
-    """Yield chunks of ≤ CHUNK_SIZE_MS each."""
-    total_ms = len(audio)
-    count = math.ceil(total_ms / CHUNK_SIZE_MS)
-    for i in range(count):
-        start = i * CHUNK_SIZE_MS
-        end   = min((i+1) * CHUNK_SIZE_MS, total_ms)
-        yield audio[start:end]
+def split_into_chunks(total_ms: int):
+    """Yield (start_ms, end_ms) ranges of ≤ CHUNK_SIZE_MS each."""
+    # integer divmod: no float ceil, and only the tail chunk is short
+    full, rest = divmod(total_ms, CHUNK_SIZE_MS)
+    for start in range(0, full * CHUNK_SIZE_MS, CHUNK_SIZE_MS):
+        yield start, start + CHUNK_SIZE_MS
+    if rest:
+        yield full * CHUNK_SIZE_MS, total_ms
+
+def process_file(info, target_ch, skip_paths, in_root, out_root, chunk_workers=1):
+    """Convert one file; returns its log lines so the parent prints them in order.
 
-def process_file(info, target_ch, skip_md5, in_root, out_root):
+    With `chunk_workers` > 1 a multi-chunk WAV file encodes its chunks side
+    by side (one ffmpeg each) instead of through a single segmenting ffmpeg.
+    """
     src = info["path"]
     # skip duplicates
-    if info["md5"] in skip_md5:
-        print(f"\n?? Skipping duplicate: {src}")
-        return
+    if info["path"] in skip_paths:
+        return [f"\n?? Skipping duplicate: {src}"]
 
-    print(f"\n?? Processing: {src}")
-    audio = AudioSegment.from_file(src)
+    log = [f"\n?? Processing: {src}"]
 
-    # 1) Channel conversion
-    if audio.channels != target_ch:
-        audio = audio.set_channels(target_ch)
-        print(f"   • Channels: {info['channels']} → {target_ch}")
+    # 1) Channel conversion (ffmpeg remixes while encoding)
+    if info["channels"] != target_ch:
+        log.append(f"   • Channels: {info['channels']} → {target_ch}")
 
     # 2) Normalize RMS
-    gain = TARGET_RMS_DBFS - audio.dBFS
-    audio = audio.apply_gain(gain)
-    print(f"   • Gain: {gain:+.1f} dB → new dBFS {audio.dBFS:.1f}")
-
-    # 3) Split into ≤119 m58 s chunks
-    chunks = list(split_into_chunks(audio))
-    if len(chunks) > 1:
-        print(f"   • Split into {len(chunks)} chunks (max {CHUNK_SIZE_MS/1000/60:.2f} min each)")
+    level = info.get("dbfs")
+    if level is None or info["channels"] > target_ch:   # a downmix changes the level
+        level = measure_dbfs(src, target_ch)
+    gain = TARGET_RMS_DBFS - level
+    if abs(gain) < MIN_GAIN_DB:
+        gain = 0.0
+        log.append("   • Already at target level, no gain needed")
+    else:
+        log.append(f"   • Gain: {gain:+.1f} dB")
 
-    # 4) Export chunks as 192 kbps CBR MP3
+    # 3) Encode as 192 kbps CBR MP3, split into ≤119 m58 s chunks
     rel = os.path.relpath(src, in_root)
-    base, _ = os.path.splitext(rel)
-    for idx, chunk in enumerate(chunks, start=1):
-        suffix = f"_part{idx}" if len(chunks) > 1 else ""
-        out_path = os.path.join(out_root, base + suffix + ".mp3")
-        os.makedirs(os.path.dirname(out_path), exist_ok=True)
-        chunk.export(
-            out_path,
-            format="mp3",
-            bitrate=BITRATE,
-            parameters=FFMPEG_PARAMS
-        )
-        dur_s = len(chunk) / 1000
-        print(f"   ✓ Saved: {out_path} [{int(dur_s//60):02d}:{int(dur_s%60):02d}]")
+    out_base = os.path.join(out_root, os.path.splitext(rel)[0])
+    os.makedirs(os.path.dirname(out_base), exist_ok=True)
+    # only PCM (WAV) has an exact header duration and sample-accurate seeks;
+    # compressed sources would drop or repeat audio at the cut points
+    chunks = list(split_into_chunks(info["duration"])) if info["pcm"] else []
+    if len(chunks) > 1 and chunk_workers > 1:
+        # spare cores: one ffmpeg per chunk, each seeking to its own slice
+        outputs = [f"{out_base}_part{i}.mp3" for i in range(1, len(chunks) + 1)]
+        ends = [end for _, end in chunks[:-1]] + [None]     # last runs to EOF
+        with ThreadPoolExecutor(max_workers=chunk_workers) as pool:
+            jobs = [pool.submit(encode_chunk, src, out_path, target_ch, gain, start, end)
+                    for out_path, (start, _), end in zip(outputs, chunks, ends)]
+            for job in jobs:
+                job.result()
+        outputs = [(out_path, (end - start) / 1000)
+                   for out_path, (start, end) in zip(outputs, chunks)]
+    else:
+        # one pass; ffmpeg's segment muxer cuts by the decoded length
+        outputs = encode_mp3(src, out_base, target_ch, gain, CHUNK_SIZE_MS)
+    if len(outputs) > 1:
+        log.append(f"   • Split into {len(outputs)} chunks (max {CHUNK_SIZE_MS/1000/60:.2f} min each)")
+    for out_path, dur_s in outputs:
+        log.append(f"   ✓ Saved: {out_path} [{int(dur_s//60):02d}:{int(dur_s%60):02d}]")
+    return log
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(
@@ -115,30 +255,36 @@ if __name__ == "__main__":
     )
     parser.add_argument("-i", "--input",  required=True, help="Raw files root dir")
     parser.add_argument("-o", "--output", required=True, help="Processed files root dir")
+    parser.add_argument("--content-dedup", action="store_true",
+                        help="Detect duplicates by decoded audio, not file bytes (slower)")
     args = parser.parse_args()
 
     # 1) Scan & analyze
-    meta = analyze_directory(args.input)
+    meta = analyze_directory(args.input, args.content_dedup)
     if not meta:
         print(f"❌ No .mp3 or .wav files found in {args.input}")
         sys.exit(1)
 
     # 2) Detect & report duplicates
     dup_groups = report_duplicates(meta)
-    skip_md5 = set()
-    for grp in dup_groups:
-        # keep the first, skip the rest
-        for dup_path in grp[1:]:
-            h = next(m["md5"] for m in meta if m["path"] == dup_path)
-            skip_md5.add(h)
+    # keep the first path in each group, skip the rest
+    skip_paths = {p for grp in dup_groups.values() for p in grp[1:]}
 
     # 3) Decide mono vs. stereo
     tgt_ch = decide_target_channels(meta)
     ch_label = "stereo (2ch)" if tgt_ch == 2 else "mono (1ch)"
     print(f"\n?? Converting all files to {ch_label}")
 
-    # 4) Process each file
-    for info in meta:
-        process_file(info, tgt_ch, skip_md5, args.input, args.output)
+    # 4) Process files in parallel, one worker per core; cores left over
+    #    when there are fewer files than that go to encoding chunks in parallel
+    n_files = len(meta) - len(skip_paths)
+    chunk_workers = max(1, (os.cpu_count() or 1) // max(1, n_files))
+    worker = partial(process_file, target_ch=tgt_ch, skip_paths=skip_paths,
+                     in_root=args.input, out_root=args.output,
+                     chunk_workers=chunk_workers)
+    # default size is one per core, capped at 61 where Windows requires it
+    with ProcessPoolExecutor(mp_context=mp.get_context("spawn")) as ex:
+        for log in ex.map(worker, meta):
+            print("\n".join(log))
 
     print(f"\n✅ All done! Your ACX-compliant MP3s are in: {args.output}")
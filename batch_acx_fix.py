@@ -2,53 +2,172 @@
 import os
 import sys
 import argparse
+import csv
 import hashlib
+import json
+import mmap
+import multiprocessing as mp
+import re
+import subprocess
+import threading
 from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
 from pydub import AudioSegment
 
+try:
+    import xxhash               # optional: much faster --content-dedup hashing
+except ImportError:
+    xxhash = None
+
 # === CONFIGURATION ===
 TARGET_RMS_DBFS    = -20.0
+MIN_GAIN_DB        = 0.1   # smaller corrections are skipped
 MAX_DURATION_MS    = 120 * 60 * 1000   # 120 minutes in ms
 BITRATE            = "192k"
-FFMPEG_PARAMS      = ["-acodec", "libmp3lame", "-b:a", BITRATE, "-write_xing", "0"]
-
-
-def compute_md5(audio: AudioSegment) -> str:
-    """Hash the raw PCM bytes to detect duplicates."""
-    return hashlib.md5(audio.raw_data).hexdigest()
-
-
-def analyze_directory(root_dir):
-    """Load every MP3, collect metadata and group duplicates."""
-    meta = []
-    for dirpath, _, files in os.walk(root_dir):
-        for f in files:
-            if not f.lower().endswith(".mp3"):
-                continue
-            full = os.path.join(dirpath, f)
-            try:
-                audio = AudioSegment.from_file(full, "mp3")
-            except Exception as e:
-                print(f"⚠️  Could not open {full!r}: {e}", file=sys.stderr)
-                continue
-            meta.append({
-                "path": full,
-                "duration_ms": len(audio),
-                "channels": audio.channels,
-                "dBFS": audio.dBFS,
-                "md5": compute_md5(audio),
-            })
-    return meta
+CODEC_PARAMS       = ["-acodec", "libmp3lame", "-b:a", BITRATE]
+
+
+def compute_file_hash(path: str) -> str:
+    """Hash the file's bytes on disk to detect duplicate files.
+
+    The file is memory-mapped, so the hash reads straight from the page cache.
+    """
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:   # empty files can't be mapped
+            return hashlib.blake2b().hexdigest()
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            return hashlib.blake2b(mm).hexdigest()
+
+
+def compute_pcm_hash(audio: AudioSegment) -> str:
+    """Hash the raw PCM bytes to catch re-encoded duplicates (--content-dedup)."""
+    if xxhash is not None:
+        return xxhash.xxh3_128(audio.raw_data).hexdigest()
+    return hashlib.sha256(audio.raw_data).hexdigest()
+
+
+def ffprobe_audio(path: str):
+    """Read channel count and duration (ms) via ffprobe, without decoding."""
+    result = subprocess.run(
+        ["ffprobe", "-v", "error", "-select_streams", "a:0",
+         "-show_streams", "-show_format", "-print_format", "json", path],
+        capture_output=True, text=True, check=True,
+    )
+    info = json.loads(result.stdout)
+    stream = info["streams"][0]
+    duration = stream.get("duration") or info["format"]["duration"]
+    return stream["channels"], int(float(duration) * 1000)
+
+
+def measure_dbfs(path: str, channels: int) -> float:
+    """RMS level of a file in dBFS once mixed to `channels`, via volumedetect."""
+    result = subprocess.run(
+        ["ffmpeg", "-hide_banner", "-nostats", "-i", path, "-vn",
+         "-ac", str(channels), "-af", "volumedetect", "-f", "null", "-"],
+        capture_output=True, text=True, check=True,
+    )
+    return float(re.search(r"mean_volume: (\S+) dB", result.stderr).group(1))
+
+
+def encode_mp3(src, out_base, channels, gain, segment_ms):
+    """Decode, remix, gain and MP3-encode `src` in a single ffmpeg run.
+
+    ffmpeg's segment muxer cuts the stream into ≤ `segment_ms` parts,
+    `<out_base>_part1.mp3`, `_part2`, ..., as it encodes, so the split follows
+    the decoded length, not the container's duration estimate. A file that
+    fits in one part is renamed to `<out_base>.mp3`. Returns a
+    (path, seconds) pair per file written.
+    """
+    cmd = ["ffmpeg", "-hide_banner", "-loglevel", "error", "-y",
+           "-i", src, "-vn", "-ac", str(channels)]
+    if gain:
+        cmd += ["-af", f"volume={gain:.2f}dB"]
+    # mp3 muxer options only reach the segments via -segment_format_options.
+    # The output name is a template, so a literal % in the path is escaped;
+    # ffmpeg lists the parts it wrote, with their times, on stdout, so stale
+    # _partN files from an earlier run aren't picked up
+    listing = subprocess.run(cmd + CODEC_PARAMS + [
+        "-f", "segment", "-segment_time", f"{segment_ms / 1000:.3f}",
+        "-segment_start_number", "1", "-reset_timestamps", "1",
+        "-segment_format_options", "write_xing=0",
+        "-segment_list", "pipe:1", "-segment_list_type", "csv",
+        out_base.replace("%", "%%") + "_part%d.mp3",
+    ], stdout=subprocess.PIPE, check=True).stdout
+    out_dir = os.path.dirname(out_base)
+    parts = [(os.path.join(out_dir, name), float(end) - float(start))
+             for name, start, end in csv.reader(os.fsdecode(listing).splitlines())]
+    if len(parts) == 1:
+        os.replace(parts[0][0], out_base + ".mp3")
+        parts = [(out_base + ".mp3", parts[0][1])]
+    return parts
+
+
+_print_lock = threading.Lock()
+
+
+def _probe(full, content_dedup=False):
+    """Collect one MP3's metadata via ffprobe; None if unreadable."""
+    try:
+        dbfs = None
+        if content_dedup:
+            # the decode is paid for already; keep its level for process_file
+            audio = AudioSegment.from_file(full, "mp3")
+            digest = compute_pcm_hash(audio)
+            dbfs = audio.dBFS if audio.rms else None
+        else:
+            digest = compute_file_hash(full)
+        channels, duration_ms = ffprobe_audio(full)
+    except Exception as e:
+        with _print_lock:
+            print(f"⚠️  Could not open {full!r}: {e}", file=sys.stderr)
+        return None
+    return {
+        "path": full,
+        "duration_ms": duration_ms,
+        "channels": channels,
+        "hash": digest,
+        "dbfs": dbfs,
+    }
+
+
+def _walk(d, exts):
+    """Yield paths under `d` ending in `exts`, via scandir's cached entry types."""
+    try:
+        it = os.scandir(d)
+    except OSError:             # missing or unreadable: skip it, like os.walk
+        return
+    with it:
+        for e in it:
+            if e.is_dir(follow_symlinks=False):
+                yield from _walk(e.path, exts)
+            elif e.name.lower().endswith(exts):
+                yield e.path
+
+
+def analyze_directory(root_dir, content_dedup=False):
+    """Probe every MP3, collect metadata and group duplicates.
+
+    Each probe is an ffprobe subprocess, so a thread pool overlaps them.
+    """
+    paths = _walk(root_dir, ".mp3")   # lazy: probing starts mid-walk
+    probe = partial(_probe, content_dedup=content_dedup)
+    # --content-dedup holds each file's whole decoded PCM (~1.3 GB for a
+    # 2-hour stereo book), so only a few of those run at once
+    cores = os.cpu_count() or 1
+    workers = min(cores, 2) if content_dedup else cores * 2
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        return [m for m in pool.map(probe, paths) if m is not None]
 
 
 def report_duplicates(meta):
     dups = defaultdict(list)
     for m in meta:
-        dups[m["md5"]].append(m["path"])
-    groups = [paths for paths in dups.values() if len(paths) > 1]
+        dups[m["hash"]].append(m["path"])
+    groups = {h: paths for h, paths in dups.items() if len(paths) > 1}
     if groups:
         print("\n??  Duplicate files detected:")
-        for grp in groups:
+        for grp in groups.values():
             print("  - " + "\n    ".join(grp))
     return groups
 
@@ -58,75 +177,72 @@ def decide_channels(meta):
     return 2 if any(m["channels"] > 1 for m in meta) else 1
 
 
-def process_file(m, target_channels, out_root, skip_hashes):
+def process_file(m, target_channels, out_root, skip_paths, input_root):
+    """Convert one file; returns its log lines so the parent prints them in order."""
     src = m["path"]
-    print(f"\n?? Processing: {src}")
-    audio = AudioSegment.from_file(src, "mp3")
+    log = [f"\n?? Processing: {src}"]
 
     # --- skip duplicates ---
-    if m["md5"] in skip_hashes:
-        print("   • Skipping duplicate.")
-        return
+    if m["path"] in skip_paths:
+        log.append("   • Skipping duplicate.")
+        return log
 
-    # --- channel conversion ---
-    if audio.channels != target_channels:
-        audio = audio.set_channels(target_channels)
-        print(f"   • Channels: {m['channels']} → {target_channels}")
+    # --- channel conversion (done by ffmpeg while encoding) ---
+    if m["channels"] != target_channels:
+        log.append(f"   • Channels: {m['channels']} → {target_channels}")
 
     # --- normalize RMS ---
-    gain = TARGET_RMS_DBFS - audio.dBFS
-    audio = audio.apply_gain(gain)
-    print(f"   • Applied gain: {gain:+.1f} dB  (new dBFS: {audio.dBFS:.1f})")
-
-    # --- splitting if needed ---
-    segments = []
-    if len(audio) > MAX_DURATION_MS:
-        print("   • Too long → splitting into ≤120 min segments")
-        for i in range(0, len(audio), MAX_DURATION_MS):
-            segments.append(audio[i : i + MAX_DURATION_MS])
+    level = m.get("dbfs")
+    if level is None or m["channels"] > target_channels:   # a downmix changes the level
+        level = measure_dbfs(src, target_channels)
+    gain = TARGET_RMS_DBFS - level
+    if abs(gain) < MIN_GAIN_DB:
+        gain = 0.0
+        log.append("   • Already at target level, no gain needed")
     else:
-        segments = [audio]
+        log.append(f"   • Applied gain: {gain:+.1f} dB")
 
-    # --- export each segment ---
-    rel_path = os.path.relpath(src, args.input)
-    base, _ = os.path.splitext(rel_path)
-    for idx, seg in enumerate(segments, 1):
-        suffix = f"_part{idx}" if len(segments) > 1 else ""
-        out_path = os.path.join(out_root, base + suffix + ".mp3")
-        os.makedirs(os.path.dirname(out_path), exist_ok=True)
-        seg.export(out_path, format="mp3", bitrate=BITRATE, parameters=FFMPEG_PARAMS)
-        print(f"   ✓ Saved: {out_path}")
+    # --- encode, splitting if needed ---
+    rel_path = os.path.relpath(src, input_root)
+    out_base = os.path.join(out_root, os.path.splitext(rel_path)[0])
+    os.makedirs(os.path.dirname(out_base), exist_ok=True)
+    outputs = encode_mp3(src, out_base, target_channels, gain, MAX_DURATION_MS)
+    if len(outputs) > 1:
+        log.append("   • Too long → split into ≤120 min segments")
+    for out_path, _ in outputs:
+        log.append(f"   ✓ Saved: {out_path}")
+    return log
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Batch-fix ACX compliance for MP3s")
     parser.add_argument("--input",  "-i", required=True, help="Directory of raw MP3s")
     parser.add_argument("--output", "-o", required=True, help="Directory for processed MP3s")
+    parser.add_argument("--content-dedup", action="store_true",
+                        help="Detect duplicates by decoded audio, not file bytes (slower)")
     args = parser.parse_args()
 
     # 1) Scan & analyze
-    metadata = analyze_directory(args.input)
+    metadata = analyze_directory(args.input, args.content_dedup)
     if not metadata:
         print("No MP3 files found in", args.input)
         sys.exit(1)
 
     # 2) Report duplicates
     dup_groups = report_duplicates(metadata)
-    # flatten all duplicate hashes except the first in each group
-    skip = set()
-    for grp in dup_groups:
-        # We'll keep grp[0], skip the rest
-        for p in grp[1:]:
-            # find its hash
-            h = next(m["md5"] for m in metadata if m["path"] == p)
-            skip.add(h)
+    # keep the first path in each group, skip the rest
+    skip = {p for grp in dup_groups.values() for p in grp[1:]}
 
     # 3) Decide target channels
     tgt_ch = decide_channels(metadata)
     print(f"\n?? Converting all files to {'stereo (2ch)' if tgt_ch==2 else 'mono (1ch)'}")
 
-    # 4) Process each unique file
-    for m in metadata:
-        process_file(m, tgt_ch, args.output, skip)
+    # 4) Process unique files in parallel (one worker per core)
+    worker = partial(process_file, target_channels=tgt_ch, out_root=args.output,
+                     skip_paths=skip, input_root=args.input)
+    # default size is one per core, capped at 61 where Windows requires it
+    with ProcessPoolExecutor(mp_context=mp.get_context("spawn")) as ex:
+        for log in ex.map(worker, metadata):
+            print("\n".join(log))
 
     print("\n✅ All done. Check above for any warnings or duplicates.")
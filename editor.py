@@ -1,6 +1,6 @@
 #!/usr/bin/env python3
 import argparse
-from moviepy.editor import VideoFileClip, AudioFileClip, CompositeAudioClip
+import subprocess
 
 def add_background_music(input_video_path: str,
                          background_audio_path: str,
@@ -15,29 +15,17 @@ def add_background_music(input_video_path: str,
         output_video_path: Path for the processed output video.
         music_volume: Relative volume for the background track (0.0–1.0).
     """
-    # Load the video
-    video = VideoFileClip(input_video_path)  # 9
-    original_audio = video.audio           # 10
-
-    # Load and adjust background music
-    bg_music = AudioFileClip(background_audio_path) \
-               .volumex(music_volume)      # 11
-    bg_music = bg_music.set_duration(video.duration)
-
-    # Composite original audio and background music
-    final_audio = CompositeAudioClip([original_audio, bg_music])  # 12
-
-    # Set composite audio back onto the video
-    video_with_music = video.set_audio(final_audio)
-
-    # Export final video
-    video_with_music.write_videofile(
-        output_video_path,
-        codec="libx264",
-        audio_codec="aac",
-        temp_audiofile="temp-audio.m4a",
-        remove_temp=True
-    )  # 13
+    # One ffmpeg pass: the video stream is copied untouched and only the
+    # audio is mixed. normalize=0 sums the tracks as moviepy's composite did.
+    mix = (f"[1:a]volume={music_volume},apad[bg];"
+           "[0:a][bg]amix=inputs=2:duration=first:dropout_transition=0:normalize=0[aout]")
+    cmd = ["ffmpeg", "-hide_banner", "-loglevel", "error", "-y",
+           "-i", input_video_path, "-i", background_audio_path,
+           "-filter_complex", mix,
+           "-map", "0:v", "-map", "[aout]",
+           "-c:v", "copy", "-c:a", "aac", "-b:a", "192k",
+           output_video_path]
+    subprocess.run(cmd, check=True)
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(
@@ -1,28 +1,123 @@
 #!/usr/bin/env python3
 import os
 import math
+import shutil
+import subprocess
 import tempfile
+import threading
 import zipfile
-from pydub import AudioSegment
+import numpy as np
+import soundfile as sf
 import gradio as gr
 
+try:
+    import lameenc              # optional: encode MP3 in-process, no ffmpeg fork
+except ImportError:
+    lameenc = None
+
+try:
+    import fcntl                # POSIX only; used to enlarge pipe buffers
+except ImportError:
+    fcntl = None
+
 # ─── CONFIG ────────────────────────────────────────────────────────────────
 TARGET_RMS_DBFS = -20.0
+MIN_GAIN_DB     = 0.1                       # smaller corrections are skipped
+GAIN_BLOCK      = 1 << 20                   # samples per fixed-point gain pass
 MAX_DURATION_MS = 120 * 60 * 1000           # 120 minutes in ms
 MARGIN_MS       = 2 * 1000                  # subtract 2 seconds
 CHUNK_SIZE_MS   = MAX_DURATION_MS - MARGIN_MS
 BITRATE         = "192k"
 FFMPEG_PARAMS   = ["-acodec", "libmp3lame", "-b:a", BITRATE, "-write_xing", "0"]
 SUPPORTED_EXTS  = (".mp3", ".wav")
+IO_BUFSIZE      = 1 << 20                   # 1 MiB pipe / ZIP write buffers
 # ───────────────────────────────────────────────────────────────────────────
 
-def split_into_chunks(audio: AudioSegment):
-    total_ms = len(audio)
-    parts = math.ceil(total_ms / CHUNK_SIZE_MS)
-    for i in range(parts):
-        start = i * CHUNK_SIZE_MS
-        end   = min((i + 1) * CHUNK_SIZE_MS, total_ms)
-        yield audio[start:end]
+def load_pcm(path):
+    """Decode to an int16 (frames, channels) array via libsndfile."""
+    return sf.read(path, dtype="int16", always_2d=True)
+
+def normalize_rms(data):
+    """Scale int16 `data` in place to TARGET_RMS_DBFS; returns the gain in dB."""
+    flat = data.reshape(-1)
+    # sum of squares accumulated in int64: no squared temporary array
+    sq = int(np.einsum("i,i->", flat, flat, dtype=np.int64))
+    if sq == 0:                       # silent or empty: no level to correct
+        return 0.0
+    rms = math.sqrt(sq / flat.size) / 32768
+    gain = TARGET_RMS_DBFS - 20 * math.log10(rms)
+    if abs(gain) < MIN_GAIN_DB:       # close enough: skip the scale and clip passes
+        return 0.0
+    # Q15 fixed-point gain; int32 products only overflow past +6 dB
+    q = round(10 ** (gain / 20) * (1 << 15))
+    wide = np.int32 if q <= 1 << 16 else np.int64
+    buf = np.empty(min(GAIN_BLOCK, flat.size), dtype=wide)
+    for start in range(0, flat.size, GAIN_BLOCK):
+        blk = flat[start:start + GAIN_BLOCK]
+        tmp = buf[:blk.size]
+        np.multiply(blk, q, out=tmp, dtype=wide)
+        np.right_shift(tmp, 15, out=tmp)
+        np.clip(tmp, -32768, 32767, out=tmp)
+        blk[...] = tmp
+    return gain
+
+def split_into_chunks(data, sample_rate):
+    """Yield ≤ CHUNK_SIZE_MS views of `data` (slicing, no copies)."""
+    step = sample_rate * CHUNK_SIZE_MS // 1000
+    for start in range(0, len(data), step):
+        yield data[start:start + step]
+
+def export_mp3(chunk, sample_rate, dst):
+    """Encode int16 PCM as a 192 kbps CBR MP3 into the writable file `dst`.
+
+    Encodes in-process if lameenc is installed, else through ffmpeg's stdout.
+    """
+    if lameenc is None:
+        cmd = ["ffmpeg", "-hide_banner", "-loglevel", "error",
+               "-f", "s16le", "-ar", str(sample_rate), "-ac", str(chunk.shape[1]),
+               "-i", "-"] + FFMPEG_PARAMS + ["-f", "mp3", "pipe:1"]
+        # communicate() feeds stdin 4 KiB at a time; write the whole buffer
+        # through a 1 MiB pipe instead, draining stdout on a thread
+        proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                bufsize=IO_BUFSIZE)
+        if hasattr(fcntl, "F_SETPIPE_SZ"):      # Linux
+            try:
+                fcntl.fcntl(proc.stdin.fileno(), fcntl.F_SETPIPE_SZ, IO_BUFSIZE)
+            except OSError:                     # over fs.pipe-max-size: keep the default
+                pass
+        read_errors = []
+
+        def drain():
+            try:
+                shutil.copyfileobj(proc.stdout, dst, IO_BUFSIZE)
+            except BaseException as e:
+                read_errors.append(e)
+                proc.kill()     # else ffmpeg blocks on stdout and our write hangs
+        reader = threading.Thread(target=drain)
+        reader.start()
+        write_error = None
+        try:
+            with proc.stdin:
+                proc.stdin.write(memoryview(chunk).cast("B"))
+        except OSError as e:    # ffmpeg exited early; its status says why
+            write_error = e
+        reader.join()
+        if read_errors:
+            proc.wait()
+            raise read_errors[0]
+        if proc.wait():
+            raise subprocess.CalledProcessError(proc.returncode, cmd) from write_error
+        if write_error is not None:
+            raise write_error
+        return
+    enc = lameenc.Encoder()
+    enc.set_bit_rate(int(BITRATE.rstrip("k")))
+    enc.set_in_sample_rate(sample_rate)
+    enc.set_channels(chunk.shape[1])
+    enc.set_quality(2)
+    # chunks are already interleaved int16: hand lameenc a view, no conversion
+    dst.write(enc.encode(memoryview(chunk).cast("B")))
+    dst.write(enc.flush())
 
 def process_audio(file_path):
     """
@@ -32,37 +127,28 @@ def process_audio(file_path):
     - Exports as 192 kbps CBR MP3
     - Zips all output files and returns the .zip path
     """
-    # 1) Prepare working dirs
-    work_out = tempfile.mkdtemp(prefix="acx_out_")
+    # 1) Prepare working dir
     zip_out  = os.path.join(tempfile.mkdtemp(prefix="acx_zip_"), "processed_audio.zip")
 
     # 2) Load audio
-    audio = AudioSegment.from_file(file_path)
+    data, sample_rate = load_pcm(file_path)
 
     # 3) Normalize RMS
-    gain = TARGET_RMS_DBFS - audio.dBFS
-    audio = audio.apply_gain(gain)
+    normalize_rms(data)
 
     # 4) Split into chunks
-    chunks = list(split_into_chunks(audio))
+    chunks = list(split_into_chunks(data, sample_rate))
 
-    # 5) Export each chunk
+    # 5) Encode each chunk straight into the ZIP; MP3 doesn't deflate, so store it
     base = os.path.splitext(os.path.basename(file_path))[0]
-    for idx, chunk in enumerate(chunks, start=1):
-        suffix = f"_part{idx}" if len(chunks) > 1 else ""
-        out_name = f"{base}{suffix}.mp3"
-        out_path = os.path.join(work_out, out_name)
-        chunk.export(
-            out_path,
-            format="mp3",
-            bitrate=BITRATE,
-            parameters=FFMPEG_PARAMS
-        )
-
-    # 6) Zip the results
-    with zipfile.ZipFile(zip_out, "w", zipfile.ZIP_DEFLATED) as zf:
-        for fn in sorted(os.listdir(work_out)):
-            zf.write(os.path.join(work_out, fn), arcname=fn)
+    # a 1 MiB write buffer batches the many small header/entry writes
+    with open(zip_out, "wb", buffering=IO_BUFSIZE) as raw, \
+         zipfile.ZipFile(raw, "w", zipfile.ZIP_STORED) as zf:
+        for idx, chunk in enumerate(chunks, start=1):
+            suffix = f"_part{idx}" if len(chunks) > 1 else ""
+            out_name = f"{base}{suffix}.mp3"
+            with zf.open(out_name, "w") as dst:
+                export_mp3(chunk, sample_rate, dst)
 
     return zip_out
 
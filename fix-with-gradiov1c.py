@@ -1,12 +1,17 @@
 #!/usr/bin/env python3
 import os
-import io
-import math
+import atexit
 import hashlib
+import mmap
+import re
+import shutil
+import subprocess
 import tempfile
+import threading
 import zipfile
-from typing import List
-from pydub import AudioSegment
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import List, Optional, Tuple
 import gradio as gr
 
 # ─── CONFIG ─────────────────────────────────────────────────────────────────────
@@ -15,48 +20,203 @@ MAX_DURATION_MS = 120 * 60 * 1000         # 120 minutes in ms
 MARGIN_MS       = 2 * 1000                # subtract 2 seconds (2000 ms)
 CHUNK_MS        = MAX_DURATION_MS - MARGIN_MS
 BITRATE         = "192k"
-FFMPEG_PARAMS   = ["-acodec", "libmp3lame", "-b:a", BITRATE, "-write_xing", "0"]
+CODEC_PARAMS    = ["-acodec", "libmp3lame", "-b:a", BITRATE]
+FFMPEG_PARAMS   = CODEC_PARAMS + ["-write_xing", "0"]
 SUPPORTED_EXTS  = (".mp3", ".wav")
+COPY_TOLERANCE_DB = 0.5                   # compliant MP3s this close aren't re-encoded
+IO_BUFSIZE      = 4 << 20                 # 4 MiB ZIP read/write buffers
+CONCURRENT_JOBS = 2                       # submissions processed at once
+JOB_WORKERS     = max(1, (os.cpu_count() or 1) // CONCURRENT_JOBS)  # cores per submission
+QUEUE_SIZE      = 32                      # submissions waiting beyond that
+ZIP_TTL_S       = 60 * 60                 # finished ZIPs are deleted after an hour
 # ────────────────────────────────────────────────────────────────────────────────
 
-def split_chunks(audio: AudioSegment):
-    total_ms = len(audio)
-    parts = math.ceil(total_ms / CHUNK_MS)
-    for i in range(parts):
-        start = i * CHUNK_MS
-        end   = min((i+1)*CHUNK_MS, total_ms)
-        yield audio[start:end]
+# every call's ZIP directory lives under one parent, removed once at exit
+ZIP_ROOT = tempfile.mkdtemp(prefix="acx_zips_")
+atexit.register(shutil.rmtree, ZIP_ROOT, ignore_errors=True)
 
-def process_files(file_paths: List[str]) -> str:
+def compute_file_hash(path: str) -> str:
+    """Hash the file's bytes on disk to detect duplicate uploads.
+
+    The file is memory-mapped, so the hash reads straight from the page cache.
+    """
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:   # empty files can't be mapped
+            return hashlib.blake2b().hexdigest()
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            return hashlib.blake2b(mm).hexdigest()
+
+def _measure(path: str):
+    """One ffmpeg volumedetect pass: (dBFS, duration in ms, MP3 kbps or None,
+    whether the stream is raw PCM)."""
+    err = subprocess.run(
+        ["ffmpeg", "-hide_banner", "-nostats", "-i", path, "-vn",
+         "-af", "volumedetect", "-f", "null", "-"],
+        capture_output=True, text=True, check=True,
+    ).stderr
+    dbfs = float(re.search(r"mean_volume: (\S+) dB", err).group(1))
+    h, m, sec = re.search(r"Duration: (\d+):(\d+):([\d.]+)", err).groups()
+    duration_ms = int((int(h) * 3600 + int(m) * 60 + float(sec)) * 1000)
+    kbps = re.search(r"Audio: mp3\b.*?(\d+) kb/s", err)
+    pcm = re.search(r"Audio: pcm_", err) is not None
+    return dbfs, duration_ms, kbps and int(kbps.group(1)), pcm
+
+def _has_vbr_header(path: str) -> bool:
+    """True if an MP3's first frame carries a Xing or VBRI (VBR) header."""
+    with open(path, "rb") as f:
+        head = f.read(10)
+        if head[:3] == b"ID3":      # skip the ID3v2 tag; its size is syncsafe
+            f.seek(10 + (head[6] << 21 | head[7] << 14 | head[8] << 7 | head[9]))
+        else:
+            f.seek(0)
+        frame = f.read(4096)        # the first frame, plus any padding before it
+    return b"Xing" in frame or b"VBRI" in frame
+
+def _ffmpeg_normalize_and_segment(path: str, out_dir: str, gain: float) -> List[str]:
+    """Decode, gain and encode `path` into `out_dir` in one ffmpeg run.
+
+    ffmpeg's segment muxer cuts ≤ CHUNK_MS parts named `<base>_part1.mp3`,
+    `_part2`, ... while encoding. Returns the paths written.
+    """
+    out_base = os.path.join(out_dir, os.path.splitext(os.path.basename(path))[0])
+    cmd = ["ffmpeg", "-hide_banner", "-loglevel", "error", "-y",
+           "-i", path, "-vn", "-af", f"volume={gain:.2f}dB"]
+    return _segment(cmd + CODEC_PARAMS, out_base)
+
+def _ffmpeg_segment_copy(path: str, out_dir: str) -> List[str]:
+    """Remux a compliant MP3, cut into ≤ CHUNK_MS parts on frame boundaries, no re-encode."""
+    out_base = os.path.join(out_dir, os.path.splitext(os.path.basename(path))[0])
+    return _segment(["ffmpeg", "-hide_banner", "-loglevel", "error", "-y",
+                     "-i", path, "-map", "0:a", "-c", "copy"], out_base)
+
+def _segment(cmd: List[str], out_base: str) -> List[str]:
+    """Run `cmd` into ffmpeg's segment muxer; returns the `_partN.mp3` paths.
+
+    The cut follows the decoded length, not the container's duration
+    estimate; a file that fits in one part is renamed to `<base>.mp3`.
+    """
+    # mp3 muxer options only reach the segments via -segment_format_options.
+    # The output name is a template, so a literal % in the path is escaped;
+    # ffmpeg lists the parts it actually wrote on stdout
+    listing = subprocess.run(cmd + [
+        "-f", "segment", "-segment_time", f"{CHUNK_MS / 1000:.3f}",
+        "-segment_start_number", "1", "-reset_timestamps", "1",
+        "-segment_format_options", "write_xing=0",
+        "-segment_list", "pipe:1", "-segment_list_type", "flat",
+        out_base.replace("%", "%%") + "_part%d.mp3",
+    ], stdout=subprocess.PIPE, check=True).stdout
+    out_dir = os.path.dirname(out_base)
+    parts = [os.path.join(out_dir, os.fsdecode(name)) for name in listing.splitlines()]
+    if len(parts) == 1:
+        os.replace(parts[0], out_base + ".mp3")
+        parts = [out_base + ".mp3"]
+    return parts
+
+def _ffmpeg_normalize_part(path: str, out_path: str, gain: float,
+                           start_ms: int, end_ms: Optional[int] = None) -> str:
+    """Encode one [start_ms, end_ms) slice of `path`; end_ms=None runs to EOF."""
+    cmd = ["ffmpeg", "-hide_banner", "-loglevel", "error", "-y",
+           "-ss", f"{start_ms / 1000:.3f}"]
+    if end_ms is not None:
+        cmd += ["-t", f"{(end_ms - start_ms) / 1000:.3f}"]
+    cmd += ["-i", path, "-vn", "-af", f"volume={gain:.2f}dB"]
+    subprocess.run(cmd + FFMPEG_PARAMS + [out_path], check=True)
+    return out_path
+
+def _process_one(path: str, work_dir: str,
+                 chunk_workers: int = 1) -> List[Tuple[str, str]]:
+    """Normalize, split and encode one file; returns (name, MP3 path) pairs.
+
+    With `chunk_workers` > 1 a multi-part WAV file encodes its parts side
+    by side (one ffmpeg each) instead of through a single segmenting ffmpeg.
+    """
+    dbfs, duration_ms, kbps, pcm = _measure(path)
+    gain = TARGET_RMS_DBFS - dbfs
+    n_parts = -(-duration_ms // CHUNK_MS)
+    # a directory per input, so same-named uploads can't collide
+    out_dir = tempfile.mkdtemp(dir=work_dir)
+    # Fast path: a 192 kbps CBR MP3 already at level is remuxed, and cut on
+    # frame boundaries if too long, skipping the decode and re-encode. ffmpeg
+    # reports a VBR file's average as its rate, so those are re-encoded
+    if (kbps == int(BITRATE.rstrip("k")) and abs(gain) < COPY_TOLERANCE_DB
+            and not _has_vbr_header(path)):
+        outputs = _ffmpeg_segment_copy(path, out_dir)
+        return [(os.path.basename(p), p) for p in outputs]
+    # only PCM (WAV) has an exact header duration and sample-accurate seeks;
+    # compressed sources would drop or repeat audio at the cut points
+    if pcm and n_parts > 1 and chunk_workers > 1:
+        # spare cores: one ffmpeg per part, each seeking to its own slice
+        out_base = os.path.join(out_dir, os.path.splitext(os.path.basename(path))[0])
+        starts = range(0, n_parts * CHUNK_MS, CHUNK_MS)
+        ends = [start + CHUNK_MS for start in starts[:-1]] + [None]   # last runs to EOF
+        with ThreadPoolExecutor(max_workers=chunk_workers) as pool:
+            jobs = [pool.submit(_ffmpeg_normalize_part, path, f"{out_base}_part{i}.mp3",
+                                gain, start, end)
+                    for i, (start, end) in enumerate(zip(starts, ends), start=1)]
+            outputs = [job.result() for job in jobs]
+    else:
+        outputs = _ffmpeg_normalize_and_segment(path, out_dir, gain)
+    return [(os.path.basename(p), p) for p in outputs]
+
+def process_files(file_paths: List[str], max_workers: Optional[int] = None,
+                  compress: bool = False) -> str:
     """
     Takes a list of local filepaths (mp3/wav), processes them,
     and returns the path to a ZIP containing all output MP3s.
+    Files are processed in parallel, one ffmpeg per worker thread; byte-identical
+    uploads are processed once and their MP3s reused under each copy's name.
+    MP3 barely deflates, so entries are stored unless `compress` is set.
     """
-    work_dir = tempfile.mkdtemp(prefix="acx_proc_")
-    zip_path = os.path.join(work_dir, "acx_processed.zip")
-    with zipfile.ZipFile(zip_path, "w", zipfile.ZIP_DEFLATED) as zf:
-        for path in file_paths:
-            ext = os.path.splitext(path)[1].lower()
-            if ext not in SUPPORTED_EXTS:
-                continue
-            audio = AudioSegment.from_file(path)
-            # Normalize RMS
-            gain = TARGET_RMS_DBFS - audio.dBFS
-            audio = audio.apply_gain(gain)
-            # Split into ≤ 119m58s chunks
-            chunks = list(split_chunks(audio))
-            base = os.path.splitext(os.path.basename(path))[0]
-            for idx, chunk in enumerate(chunks, start=1):
-                suffix = f"_part{idx}" if len(chunks)>1 else ""
-                out_name = f"{base}{suffix}.mp3"
-                out_path = os.path.join(work_dir, out_name)
-                chunk.export(
-                    out_path,
-                    format="mp3",
-                    bitrate=BITRATE,
-                    parameters=FFMPEG_PARAMS
-                )
-                zf.write(out_path, arcname=out_name)
+    # only the ZIP outlives the call, for ZIP_TTL_S after it's written or
+    # until the app exits; the MP3s are removed as soon as they're zipped
+    zip_dir = tempfile.mkdtemp(prefix="acx_proc_", dir=ZIP_ROOT)
+    zip_path = os.path.join(zip_dir, "acx_processed.zip")
+    try:
+        paths = [p for p in file_paths
+                 if os.path.splitext(p)[1].lower() in SUPPORTED_EXTS]
+        # the same bytes uploaded twice are encoded once; the first copy wins
+        hashes = [compute_file_hash(p) for p in paths]
+        first = {}
+        for path, digest in zip(paths, hashes):
+            first.setdefault(digest, path)
+        with tempfile.TemporaryDirectory(prefix="acx_work_") as work_dir:
+            # workers only wait on ffmpeg, so threads will do; the ZIP is written
+            # here, once they're done. Workers left over when there are fewer files
+            # go to encoding parts
+            workers = int(max_workers or JOB_WORKERS)
+            chunk_workers = max(1, workers // max(1, len(first)))
+            with ThreadPoolExecutor(max_workers=workers) as ex:
+                done = dict(zip(first.values(),
+                                ex.map(partial(_process_one, work_dir=work_dir,
+                                               chunk_workers=chunk_workers),
+                                       first.values())))
+            results = []
+            for path, digest in zip(paths, hashes):
+                src = first[digest]
+                src_base = os.path.splitext(os.path.basename(src))[0]
+                base = os.path.splitext(os.path.basename(path))[0]
+                if path == src:
+                    results.append(done[src])
+                elif base != src_base:      # a same-named copy would only repeat entries
+                    results.append([(base + name[len(src_base):], out_path)
+                                    for name, out_path in done[src]])
+            method = zipfile.ZIP_DEFLATED if compress else zipfile.ZIP_STORED
+            # zf.write() copies entries 8 KiB at a time; stream each one in 4 MiB
+            # blocks instead, and batch the archive's writes through a 4 MiB buffer
+            with open(zip_path, "wb", buffering=IO_BUFSIZE) as raw, \
+                 zipfile.ZipFile(raw, "w", method, allowZip64=True) as zf:
+                for outputs in results:
+                    for out_name, out_path in outputs:
+                        zinfo = zipfile.ZipInfo.from_file(out_path, arcname=out_name)
+                        zinfo.compress_type = method
+                        with open(out_path, "rb") as src, zf.open(zinfo, "w") as dst:
+                            shutil.copyfileobj(src, dst, IO_BUFSIZE)
+    except BaseException:
+        shutil.rmtree(zip_dir, ignore_errors=True)
+        raise
+    reaper = threading.Timer(ZIP_TTL_S, shutil.rmtree, (zip_dir,), {"ignore_errors": True})
+    reaper.daemon = True
+    reaper.start()
     return zip_path
 
 # ─── GRADIO UI ──────────────────────────────────────────────────────────────────
@@ -72,6 +232,17 @@ with gr.Blocks() as demo:
         file_count="multiple",
         type="filepath"               # <— use filepath, not 'file'
     )
+    max_workers = gr.Slider(
+        minimum=1,
+        maximum=os.cpu_count() or 1,
+        value=JOB_WORKERS,                # overlapping submissions share the cores
+        step=1,
+        label="Max parallel files / ffmpeg workers"
+    )
+    compress = gr.Checkbox(
+        value=False,
+        label="Compress ZIP (slower, MP3s shrink <1%)"
+    )
     process_btn = gr.Button("Process Files")
     output_zip = gr.File(
         label="Download Processed ZIP",
@@ -79,12 +250,18 @@ with gr.Blocks() as demo:
     )
     process_btn.click(
         fn=process_files,
-        inputs=file_input,
+        inputs=[file_input, max_workers, compress],
         outputs=output_zip
     )
     gr.Markdown("Made with ❤️ for ACX compliance.")
 
 if __name__ == "__main__":
+    # let submissions overlap; the knob was renamed in Gradio 4
+    if int(gr.__version__.split(".")[0]) >= 4:
+        demo.queue(default_concurrency_limit=CONCURRENT_JOBS, max_size=QUEUE_SIZE)
+    else:
+        demo.queue(concurrency_count=CONCURRENT_JOBS, max_size=QUEUE_SIZE)
+
     # host on all interfaces, port 7654, and also get a Gradio share link (expires in 1 week)
     launch_result = demo.launch(
         server_name="0.0.0.0",